@@ -1,18 +1,26 @@
+import sys
 import tqdm
 
+# batch runs (cron, CI, redirected output) write no progress, notebooks keep it
+_QUIET = not sys.stderr.isatty() and not 'ipykernel' in sys.modules
+
 ##############################################################################
 class ProgressBar():
     def __init__(self, n):
-        self.pbar = tqdm.tqdm(total = n)
+        # postfix changes are drawn together with the next update, at most once a second
+        self.pbar = tqdm.tqdm(total = n, disable = _QUIET, mininterval = 1.0)
         self.postfix = {}
         
     def set_postfix(self, name:str, postfix:str):
         self.postfix[name] = postfix
-        self.pbar.set_postfix(self.postfix)
+        if not _QUIET:
+            self.pbar.set_postfix(self.postfix, refresh = False)
         return self
 
     def update(self):
-        self.pbar.set_postfix(self.postfix)
+        if _QUIET:
+            return
+        self.pbar.set_postfix(self.postfix, refresh = False)
         self.pbar.update(1)
 
         if(self.pbar.n == self.pbar.total):
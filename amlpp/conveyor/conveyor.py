@@ -1,5 +1,11 @@
+from sklearn.metrics import r2_score, roc_auc_score, accuracy_score, explained_variance_score
 from sklearn.inspection import permutation_importance
+from sklearn.model_selection import train_test_split
+from sklearn.preprocessing import LabelEncoder
 
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from functools import lru_cache
 from typing import List, Callable
 
 from datetime import datetime
@@ -10,16 +16,101 @@ import pandas as pd
 import numpy as np
 import warnings
 import optuna
-import pickle
+import joblib
 import tqdm 
 import shap
 import time
 import gc
+import os
 
 from ..fit_model import *
 from ..additional import *
 
 optuna.logging.set_verbosity(optuna.logging.WARNING)
+
+# default optuna optimizer parameters of fit_model
+_DEFAULT_FIT_PARAMS = MappingProxyType({"n_trials":100, "n_jobs":os.cpu_count(), 'show_progress_bar':False})
+
+# aliases of num_iterations and early_stopping_round in lgbm params, they would override
+# n_estimators of the sklearn wrapper that refits the tuned model
+_LGBM_ITERATION_PARAMS = frozenset(['num_iterations', 'num_iteration', 'n_iter', 'num_tree', 'num_trees', 
+                                    'num_round', 'num_rounds', 'nrounds', 'num_boost_round', 'n_estimators', 
+                                    'max_iter', 'early_stopping_round', 'early_stopping_rounds', 
+                                    'early_stopping', 'n_iter_no_change'])
+
+# fit_transform collects cycle-referenced frames once per this number of blocks
+_GC_BLOCKS = 5
+
+# lz4 compresses the saved models much faster than the zlib fallback
+try:
+    import lz4
+    _JOBLIB_COMPRESS = ('lz4', 3)
+except ImportError:
+    _JOBLIB_COMPRESS = 3
+
+# sklearn functions available by name in Conveyor.score
+_METRIC_REGISTRY = {'r2_score': r2_score,
+                    'roc_auc_score': roc_auc_score,
+                    'accuracy_score': accuracy_score,
+                    'explained_variance_score': explained_variance_score}
+
+def _copy_on_write() -> bool:
+    """ Whether the user enabled pandas Copy-on-Write (stable from pandas 2.0), 
+    the conveyor does not change this option itself
+    """
+    if int(pd.__version__.split('.')[0]) < 2:
+        return False
+    try:
+        return pd.get_option("mode.copy_on_write") is True
+    except KeyError:
+        # the option is gone once Copy-on-Write is the only behaviour
+        return True
+
+def _lazy_copy(data:pd.DataFrame or pd.Series or np.ndarray) -> pd.DataFrame or pd.Series or np.ndarray:
+    """ Copy protecting the caller's data from in-place changes of the blocks,
+    shallow under Copy-on-Write (columns are copied only when written)
+    """
+    if isinstance(data, (pd.DataFrame, pd.Series)):
+        return data.copy(deep = not _copy_on_write())
+    return np.copy(data)
+
+def _take_rows(data:pd.DataFrame or pd.Series or np.ndarray, rows:np.ndarray):
+    """ Positional selection of rows for pandas and numpy data
+    """
+    return data.iloc[rows] if isinstance(data, (pd.DataFrame, pd.Series)) else data[rows]
+
+# permutation importances of an unchanged estimator on unchanged data can be read from disk,
+# for fewer rows hashing the arguments costs as much as the computation
+_CACHE_MIN_ROWS = 1000
+
+@lru_cache(maxsize = None)
+def _memory(cache_dir:str) -> joblib.Memory:
+    """ Disk cache in the directory, created on first use
+    """
+    return joblib.Memory(cache_dir, verbose = 0)
+
+def _shap_values(estimator:object, background:pd.DataFrame, X:pd.DataFrame) -> shap.Explanation:
+    """ SHAP values, tree models (lgbm, xgboost, catboost, sklearn trees) are explained 
+    by the fast tree path algorithm, other models by the generic explainer over the background sample
+    (models shap does not know, such as knn or adaboost, through their predict function)
+    """
+    try:
+        explainer = shap.TreeExplainer(estimator, feature_perturbation = 'tree_path_dependent')
+    except Exception:
+        try:
+            explainer = shap.Explainer(estimator, background)
+        except Exception:
+            explainer = shap.Explainer(estimator.predict, background)
+    return explainer(X)
+
+def _permutation_importance(estimator:object, X:pd.DataFrame, Y:pd.DataFrame or pd.Series, cache_dir:str = None):
+    """ Permutation importances, repeats are computed in parallel,
+    cached on disk if cache_dir is given and the data is not small
+    """
+    if cache_dir is None or len(X) < _CACHE_MIN_ROWS:
+        return permutation_importance(estimator, X, Y, n_repeats=2, random_state=42, n_jobs=-1)
+    return _memory(cache_dir).cache(_permutation_importance)(estimator, X, Y)
+
 ##############################################################################
 class Conveyor:
     """Conveyor consisting of blocks that carry processing of
@@ -34,15 +125,26 @@ class Conveyor:
     def __init__(self, *blocks, estimator:object  = None):
         self.blocks = list(blocks)
         self.estimator = estimator
+        self._last_split = None
+        self._ort_sess = None
+        self._index_blocks()
         warnings.filterwarnings('ignore')
         
     def __repr__(self):
         _repr = self.__class__.__name__ + "= (\n"
         indent = " " * (len(_repr) - 1)
-        for block in self.blocks:
-            _repr += f"{indent}{repr(block)}, \n"
-        _repr += f"{indent}estimator = {repr(self.estimator)}\n{indent} )"
-        return _repr
+        blocks = "".join(f"{indent}{repr(block)}, \n" for block in self.blocks)
+        return f"{_repr}{blocks}{indent}estimator = {repr(self.estimator)}\n{indent} )"
+
+    def __getstate__(self):
+        # the onnx session is not saved together with the model
+        return {**self.__dict__, '_ort_sess':None}
+
+    def _index_blocks(self):
+        """ Caching which blocks transform targets and which blocks are applied by predict
+        """
+        self._has_target_transform = {id(block):hasattr(block, 'target_transform') for block in self.blocks}
+        self._predict_blocks = [block for block in self.blocks if not getattr(block, 'skip_at_predict', False)]
 
     ##############################################################################
     def fit(self, X:pd.DataFrame, Y:pd.DataFrame or pd.Series):
@@ -72,12 +174,20 @@ class Conveyor:
         transformed data : list or pd.DataFrame
             Transformed data
         """
-        X_, Y_  = (X.copy(), Y.copy())
+        self._index_blocks()
+        self._ort_sess = None
+        X_, Y_  = (_lazy_copy(X), _lazy_copy(Y))
 
-        pbar = ProgressBar(len(self.blocks) + int(estimator))
-        for block in self.blocks:
+        pbar = ProgressBar(len(self.blocks) + (1 if estimator else 0))
+        for i, block in enumerate(self.blocks, 1):
             pbar.set_postfix('transform', block.__class__.__name__)
-            X_, Y_ = self._transform(block.fit(X_, Y_), X_, Y_)
+            new_X, new_Y = self._transform(block.fit(X_, Y_), X_, Y_)
+            # only one materialized frame stays alive between blocks
+            del X_, Y_
+            X_, Y_ = new_X, new_Y
+            del new_X, new_Y
+            if i % _GC_BLOCKS == 0:
+                gc.collect()
             pbar.update()
 
         if estimator:
@@ -89,20 +199,20 @@ class Conveyor:
     ##############################################################################
     def transform(self,
                         X:pd.DataFrame,
-                        Y:pd.DataFrame or pd.Series = pd.DataFrame()):
+                        Y:pd.DataFrame or pd.Series = None):
         """ Сonducting input data through transformers
         Parameters
         ----------
         X : pd.DataFrame
             Input data, features (regressors)
-        Y : pd.DataFrame or pd.Series
+        Y : pd.DataFrame or pd.Series = None
             Input data, targets
         Returns
         ----------
         transformed data : list or pd.DataFrame
             Transformed data
         """
-        X_, Y_  = (X.copy(), Y.copy())
+        X_, Y_  = (_lazy_copy(X), None if Y is None else _lazy_copy(Y))
         for block in self.blocks:
             X_, Y_ = self._transform(block, X_, Y_)
         return X_, Y_
@@ -110,7 +220,7 @@ class Conveyor:
     def _transform(self, 
                         block:Callable,
                         X:pd.DataFrame,
-                        Y:pd.DataFrame or pd.Series = pd.DataFrame()):
+                        Y:pd.DataFrame or pd.Series = None):
         """ Using a transformer
         Parameters
         ----------
@@ -118,7 +228,7 @@ class Conveyor:
             Transformer
         X : pd.DataFrame
             Input data, features (regressors)
-        Y : pd.DataFrame or pd.Series
+        Y : pd.DataFrame or pd.Series = None
             Input data, targets
         Returns
         ----------
@@ -126,30 +236,125 @@ class Conveyor:
             Transformed data
         """
         X = block.transform(X)
-        if not Y.empty and 'target_transform' in dir(block):
+        if Y is not None and not Y.empty and self._block_target_transform(block):
             Y = block.target_transform(Y)
         return X, Y
         
+    def _block_target_transform(self, block:Callable) -> bool:
+        """ Whether the block transforms targets, cached per block
+        (blocks added after the last fit are looked up once)
+        """
+        has_target_transform = self.__dict__.setdefault('_has_target_transform', {})
+        if not id(block) in has_target_transform:
+            has_target_transform[id(block)] = hasattr(block, 'target_transform')
+        return has_target_transform[id(block)]
+        
     ##############################################################################
-    def predict(self, X:pd.DataFrame):
-        """ Getting the result
+    def predict(self, X:pd.DataFrame, transform:bool = True):
+        """ Getting the result, blocks marked skip_at_predict are not applied
         Parameters
         ----------
         X : pd.DataFrame
             Input data, features (regressors)
+        transform : bool = True
+            Pass the data through the transformers, False if X is already transformed
         Returns
         ----------
         output : list
             prediction
         """
-        return self.estimator.predict(self.transform(X.copy())[0])
+        X_ = self._predict_transform(X) if transform else X
+        if getattr(self, '_ort_sess', None) is not None:
+            return self._ort_sess.run(None, {'input':np.asarray(X_, dtype = np.float32)})[0].ravel()
+        return self.estimator.predict(X_)
+
+    def predict_batch(self, X:pd.DataFrame, batch_size:int = 10000, transform:bool = True):
+        """ Getting the result in batches of rows, 
+        so that each batch passes all the blocks while its data is still in the cache
+        Parameters
+        ----------
+        X : pd.DataFrame or np.ndarray
+            Input data, features (regressors)
+        batch_size : int = 10000
+            Number of rows in a batch
+        transform : bool = True
+            Pass the data through the transformers, False if X is already transformed
+        Returns
+        ----------
+        output : np.ndarray
+            prediction
+        """
+        if len(X) <= batch_size:
+            return self.predict(X, transform)
+        return np.concatenate([self.predict(_take_rows(X, slice(start, start + batch_size)), transform) 
+                                for start in range(0, len(X), batch_size)])
+
+    def to_onnx(self, sample_X:pd.DataFrame, transform:bool = True):
+        """ Conversion of the estimator to ONNX, after which predict computes 
+        the result with onnxruntime (the blocks still run in python, as the 
+        conveyor transformers have no ONNX converters). 
+        Requires skl2onnx and onnxruntime, and onnxmltools for lgbm estimators;
+        if the conversion fails, or the onnx model can not take the sample or 
+        predicts differently from the estimator, the python estimator is kept.
+        Parameters
+        ----------
+        sample_X : pd.DataFrame
+            Input data sample, defines the number of features
+        transform : bool = True
+            Pass the sample through the transformers, False if it is already transformed
+        Returns
+        ----------
+        onnx_model : ModelProto or None
+            Converted model
+        """
+        try:
+            import onnxruntime
+
+            sample_X_ = self._predict_transform(sample_X) if transform else sample_X
+            n_features = np.asarray(sample_X_).shape[1]
+            if isinstance(self.estimator, lgb.LGBMModel):
+                from onnxmltools import convert_lightgbm
+                from onnxmltools.convert.common.data_types import FloatTensorType
+                onnx_model = convert_lightgbm(self.estimator, initial_types = [('input', FloatTensorType([None, n_features]))])
+            else:
+                from skl2onnx import convert_sklearn
+                from skl2onnx.common.data_types import FloatTensorType
+                onnx_model = convert_sklearn(self.estimator, initial_types = [('input', FloatTensorType([None, n_features]))])
+
+            session = onnxruntime.InferenceSession(onnx_model.SerializeToString(), 
+                                                   providers = onnxruntime.get_available_providers())
+
+            # the session is used only if it takes this data and predicts like the estimator
+            onnx_pred = session.run(None, {'input':np.asarray(sample_X_, dtype = np.float32)})[0].ravel()
+            pred = np.ravel(self.estimator.predict(sample_X_))
+            try:
+                same = np.allclose(onnx_pred.astype(np.float64), pred.astype(np.float64), rtol = 1e-3, atol = 1e-5)
+            except (ValueError, TypeError):
+                same = np.array_equal(onnx_pred.astype(str), pred.astype(str))
+            if not same:
+                raise ValueError('onnx predictions differ from the estimator predictions')
+
+            self._ort_sess = session
+            return onnx_model
+        except Exception as e:
+            print('onnx conversion - ERROR: ', e)
+            self._ort_sess = None
+
+    def _predict_transform(self, X:pd.DataFrame) -> pd.DataFrame:
+        """ Conducting input data through the blocks needed for prediction
+        """
+        X_ = _lazy_copy(X)
+        for block in getattr(self, '_predict_blocks', self.blocks):
+            X_ = block.transform(X_)
+        return X_
 
     ##############################################################################
     def score(self,
                 X:pd.DataFrame,
                 Y:pd.DataFrame or pd.Series,
                 sklearn_function:List[str] = ['r2_score','roc_auc_score', 'accuracy_score', 'explained_variance_score'],
-                precision_function:List[Callable] = []):
+                precision_function:List[Callable] = [],
+                transform:bool = True):
         """ Function of obtaining an estimate on test data
         Parameters
         ----------
@@ -161,15 +366,29 @@ class Conveyor:
             sklearn function to evaluate
         precision_function : List [Callable] = []
             custom evaluation functions
+        transform : bool = True
+            Pass the data through the transformers, False if X, Y are already transformed
+            (the result of transform can be reused by several calls)
         """
-        X_, Y_ = self.transform(X.copy(), Y.copy())
+        X_, Y_ = self.transform(X, Y) if transform else (X, Y)
         result = self.estimator.predict(X_)
 
-        score = ""
-        for func in sklearn_function:
-            score += self._get_score(eval(func), Y_, result)
-        for func in precision_function:
-            score += self._get_score(func, Y_, result)
+        # sklearn metrics get contiguous arrays converted once instead of validating pandas data per metric
+        try:
+            y_true = np.ascontiguousarray(Y_, dtype = np.float64)
+            y_pred = np.ascontiguousarray(result, dtype = np.float64)
+        except (ValueError, TypeError):
+            y_true, y_pred = np.asarray(Y_), np.asarray(result)
+        try:
+            single_class = 'roc_auc_score' in sklearn_function and np.unique(y_true).size < 2
+        except TypeError:
+            single_class = False
+
+        score = "".join(f"function - {name} = SKIPPED: only one class in y_true\n" 
+                            if name == 'roc_auc_score' and single_class 
+                            else self._get_score(_METRIC_REGISTRY[name], y_true, y_pred)
+                        for name in sklearn_function)
+        score += "".join(self._get_score(func, Y_, result) for func in precision_function)
 
         print(score)
     
@@ -184,7 +403,9 @@ class Conveyor:
                             X:pd.DataFrame, Y:pd.DataFrame or pd.Series, 
                             show:str = ['sklearn', "lgbm"],
                             save:bool = True,
-                            name_plot:str = ""): 
+                            name_plot:str = "",
+                            transform:bool = True,
+                            cache_dir:str = None): 
         """Plotting feature importances
          Parameters
          ----------
@@ -198,8 +419,14 @@ class Conveyor:
              Save graphs as images
          name_plot: str = ""
              Chart name
+         transform : bool = True
+             Pass the data through the transformers, False if X, Y are already transformed
+             (the result of transform can be reused by several calls)
+         cache_dir : str = None
+             Directory of the disk cache of permutation importances, not cached by default
          """
-        X_, Y_ = self.transform(X.copy(), Y.copy())
+        X_, Y_ = self.transform(X, Y) if transform else (X, Y)
+        index = X_.columns if isinstance(X_, pd.DataFrame) else getattr(X, 'columns', None)
         
         name_plot = name_plot if name_plot != "" else datetime.now().strftime("%Y-%m-%d_%M")
 
@@ -211,8 +438,9 @@ class Conveyor:
 
         if 'all' in show  or 'shap' in show:
             try:
-                explainer = shap.Explainer(self.estimator)
-                shap_values = explainer(X_)
+                # only the first row is plotted, no need to explain the whole dataset
+                background = shap.utils.sample(X_, 100, random_state = 42)
+                shap_values = _shap_values(self.estimator, background, X_[:1])
                 shap.plots.bar(shap_values[0], show = False)
                 if save:
                     plt.savefig(f'{name_plot}_shap.jpeg', dpi = 150,  pad_inches=0)
@@ -222,8 +450,8 @@ class Conveyor:
 
         if "all" in show  or "sklearn" in show:
             try:
-                result = permutation_importance(self.estimator, X_, Y_, n_repeats=2, random_state=42)
-                index = X_.columns if type(X_) == pd.DataFrame else X.columns
+                rows = np.random.default_rng(42).choice(len(X_), min(len(X_), 5000), replace = False)
+                result = _permutation_importance(self.estimator, _take_rows(X_, rows), _take_rows(Y_, rows), cache_dir)
                 forest_importances = pd.Series(result.importances_mean, index=index)
                 fig, ax = plt.subplots(figsize=(20, 10))
                 forest_importances.plot.bar(yerr=result.importances_std, ax=ax)
@@ -238,7 +466,8 @@ class Conveyor:
     def fit_model(self, X:pd.DataFrame, Y:pd.DataFrame or pd.Series, type_model:str,
                     verbose:bool = True,
                     optuna_params:dict = {}, optimize_params:dict = {},
-                    categorical_columns:List[str] = []):
+                    categorical_columns:List[str] = [],
+                    storage:str = None):
         """ Model selection
         Parameters
         ----------
@@ -246,42 +475,64 @@ class Conveyor:
             Input data, features (regressors)
         Y : pd.DataFrame or pd.Series
             Input data, targets
-        optuna_params : dict = {"n_trials": 100, "n_jobs": -1, 'show_progress_bar': False}
-            Optuna optimizer parameters for select sklearn and lgbm model
+        optuna_params : dict = {"n_trials": 100, "n_jobs": os.cpu_count(), 'show_progress_bar': False}
+            Optuna optimizer parameters for select sklearn and lgbm model,
+            lgbm and sklearn models are tuned concurrently only if n_jobs is lower than the number of cores
+            (with the default n_jobs they are tuned one after another)
         categorical_columns : List [str] = []
             Category column names for lgbm optuna optimizer
+        storage : str = None
+            Optuna storage url (for example "sqlite:///optuna.db"), studies are
+            named after the model and resumed if they already exist,
+            boosters of the lgbm tuner are then kept in <model name>_boosters directories
         """
-        optuna_params = {"n_trials":100,  "n_jobs" :-1, 'show_progress_bar':False, **optuna_params}
+        optuna_params = {**_DEFAULT_FIT_PARAMS, **optuna_params}
         best_model = {"model":object, "params":{}, "best_value":0 }
         X_, Y_ = self.fit_transform(X, Y)
 
         # Дополнительные параметры для lgbm модели
         params_columns = {'verbose':False}
-        if type(X_) == pd.DataFrame:
-            params_columns["feature_name"] =  list(X_.columns)
-            params_columns['categorical_feature'] = [col for col in categorical_columns if col in params_columns['feature_name']]
+        if isinstance(X_, pd.DataFrame):
+            feature_name = X_.columns.tolist()
+            feature_set = set(feature_name)
+            params_columns["feature_name"] = feature_name
+            params_columns['categorical_feature'] = [col for col in categorical_columns if col in feature_set]
 
+        fitted_models = []
         try:
             models = models_regression if type_model == 'regression' else models_classification
+            try:
+                import optuna.integration.lightgbm
+                lgbm_models = [model for model in models if issubclass(model, lgb.LGBMModel)]
+            except ImportError:
+                # without optuna-integration lgbm is tuned by the optuna study like the other models
+                lgbm_models = []
+            sklearn_models = {model:models[model] for model in models if not model in lgbm_models}
+
+            # one holdout split (rows) shared by the tuners and kept for later re-evaluation
+            self._last_split = None
+            if lgbm_models or not optimize_params.get('cross_validation', True):
+                self._last_split = self._holdout_split(X_, Y_, type_model, optimize_params.get('test_size', 0.2))
 
-            pb = ProgressFitModel(optuna_params['n_trials'] * len(models), best_model['best_value'])
-            for model in models:
-                pb.set_postfix('model', model.__name__)
-                study = optuna.create_study(direction="maximize")
-
-                if model.__name__ == 'LGBMRegressor':
-                    add_params = params_columns
-                else:
-                    add_params = {}
-                    
-                study.optimize(Optimizer(X_, Y_, model, models[model], add_params, pb, **optimize_params
-                              ), callbacks=[lambda study, trial: gc.collect()], **optuna_params)
-
-                currrent_model = {"model":model, "params":study.best_params, "best_value":study.best_value}
-                self._update_fit_model_log(currrent_model)
-                if study.best_value > best_model['best_value']:
-                    best_model = currrent_model
-                    print(self._repr_dict_model(best_model))
+            # lgbm and sklearn tuning run side by side only if one study leaves free cores
+            n_jobs = optuna_params['n_jobs']
+            max_workers = 2 if n_jobs is not None and 0 < n_jobs < (os.cpu_count() or 1) else 1
+
+            # the stepwise lgbm tuning is a single step of the progress bar
+            pb = ProgressFitModel(optuna_params['n_trials'] * len(sklearn_models) + len(lgbm_models), best_model['best_value'])
+            with ThreadPoolExecutor(max_workers = max_workers) as executor:
+                lgbm_futures = [executor.submit(self._fit_lgbm_model, X_, Y_, model, self._last_split, 
+                                                params_columns, pb, optimize_params, storage)
+                                for model in lgbm_models]
+                sklearn_future = executor.submit(self._fit_sklearn_models, X_, Y_, sklearn_models, params_columns, pb,
+                                                 optuna_params, optimize_params, storage, self._last_split)
+                for model, future in zip(lgbm_models, lgbm_futures):
+                    try:
+                        fitted_models.append(future.result())
+                    except Exception as e:
+                        print(f'{model.__name__} tuning aborted - ERROR: ', e)
+                fitted_models += sklearn_future.result()
+            pb.close()
 
         except Exception as e:
             print(e)
@@ -289,13 +540,149 @@ class Conveyor:
                 raise e
             print(e)
 
+        for currrent_model in fitted_models:
+            self._update_fit_model_log(currrent_model)
+            if currrent_model['best_value'] > best_model['best_value']:
+                best_model = currrent_model
+                print(self._repr_dict_model(best_model))
+
         model = best_model['model'](**best_model['params']).fit(X_, Y_)
         print(self._repr_dict_model(best_model))
 
         self.estimator = model
         print("*"*100, f'\nBest model = {self.estimator}')
-        with open("model_" + datetime.now().strftime("%Y_%m_%d_m%M"), 'wb') as save_file:
-            pickle.dump(self, save_file)
+        joblib.dump(self, "model_" + datetime.now().strftime("%Y_%m_%d_m%M") + ".joblib", compress = _JOBLIB_COMPRESS)
+
+    def _fit_sklearn_models(self, X:pd.DataFrame, Y:pd.DataFrame or pd.Series, models:dict,
+                            params_columns:dict, pbar:ProgressFitModel,
+                            optuna_params:dict, optimize_params:dict = {}, storage:str = None,
+                            split_rows:list = None) -> List[dict]:
+        """ Selection of hyperparameters of the models by optuna studies
+        Parameters
+        ----------
+        X : pd.DataFrame
+            Transformed data, features (regressors)
+        Y : pd.DataFrame or pd.Series
+            Transformed data, targets
+        models : dict
+            Models and functions of their hyperparameters
+        params_columns : dict
+            Additional fit parameters of lgbm models (feature names and categorical features)
+        pbar : ProgressFitModel
+            Model selection progress bar
+        optuna_params : dict
+            Optuna optimizer parameters
+        optimize_params : dict = {}
+            Optimizer parameters
+        storage : str = None
+            Optuna storage url
+        split_rows : list = None
+            Train and test rows of the holdout split, used when cross validation is off
+        Returns
+        ----------
+        fitted_models : List [dict]
+            Model, best parameters and best value of each study
+        """
+        fitted_models = []
+        for model in models:
+            pbar.set_postfix('model', model.__name__)
+            study = optuna.create_study(direction="maximize",
+                                        sampler=optuna.samplers.TPESampler(multivariate=True, group=True, 
+                                                                           n_startup_trials=20, seed=42),
+                                        pruner=optuna.pruners.HyperbandPruner(min_resource=1, 
+                                                                              max_resource=optimize_params.get('k_fold', 5),
+                                                                              reduction_factor=3),
+                                        storage=storage,
+                                        study_name=model.__name__ if storage else None,
+                                        load_if_exists=True)
+            fit_params = params_columns if issubclass(model, lgb.LGBMModel) else {}
+            # a failed trial is recorded by optuna, a model without completed trials is skipped
+            try:
+                study.optimize(Optimizer(X, Y, model, models[model], fit_params, pbar, split_rows = split_rows, **optimize_params
+                              ), catch=(Exception,), **optuna_params)
+                fitted_models.append({"model":model, "params":study.best_params, "best_value":study.best_value})
+            except Exception as e:
+                print(f'{model.__name__} tuning aborted - ERROR: ', e)
+        return fitted_models
+
+    def _holdout_split(self, X:pd.DataFrame, Y:pd.DataFrame or pd.Series, type_model:str, test_size:float) -> list:
+        """ Train and test rows of the holdout split, stratified for classification
+        """
+        rows = np.arange(len(X))
+        try:
+            return train_test_split(rows, test_size = test_size, random_state = 42,
+                                    stratify = Y if type_model != 'regression' else None)
+        except ValueError:
+            # a class with a single row can not be stratified
+            return train_test_split(rows, test_size = test_size, random_state = 42)
+
+    def _fit_lgbm_model(self, X:pd.DataFrame, Y:pd.DataFrame or pd.Series, model:Callable,
+                        split_rows:list, params_columns:dict, pbar:ProgressFitModel,
+                        optimize_params:dict = {}, storage:str = None) -> dict:
+        """ Stepwise selection of lgbm hyperparameters with the optuna LightGBM tuner
+        Parameters
+        ----------
+        X : pd.DataFrame
+            Transformed data, features (regressors)
+        Y : pd.DataFrame or pd.Series
+            Transformed data, targets
+        model : Callable
+            LGBMRegressor or LGBMClassifier
+        split_rows : list
+            Train and test rows of the holdout split
+        params_columns : dict
+            Additional fit parameters (feature names and categorical features)
+        pbar : ProgressFitModel
+            Model selection progress bar
+        optimize_params : dict = {}
+            Optimizer parameters, used to score the tuned model like the other models
+        storage : str = None
+            Optuna storage url
+        Returns
+        ----------
+        model : dict
+            Model, tuned parameters and value of the rating function
+        """
+        import optuna.integration.lightgbm as olgb
+
+        # lgb.train takes classes as 0..K-1, LGBMClassifier encoded them itself
+        labels = Y
+        if issubclass(model, lgb.LGBMClassifier):
+            encoder = LabelEncoder()
+            labels = encoder.fit_transform(np.ravel(Y))
+
+        if not issubclass(model, lgb.LGBMClassifier):
+            base_params, direction = {'objective':'regression', 'metric':'rmse'}, 'minimize'
+        elif len(encoder.classes_) > 2:
+            base_params, direction = {'objective':'multiclass', 'metric':'multi_logloss', 'num_class':len(encoder.classes_)}, 'minimize'
+        else:
+            base_params, direction = {'objective':'binary', 'metric':'auc'}, 'maximize'
+        base_params = {**base_params, 'verbosity':-1, 'random_state':42}
+
+        categorical_feature = params_columns.get('categorical_feature', 'auto')
+        train_rows, test_rows = split_rows
+        X_train, X_test = _take_rows(X, train_rows), _take_rows(X, test_rows)
+        Y_train, Y_test = _take_rows(labels, train_rows), _take_rows(labels, test_rows)
+        train_set = lgb.Dataset(X_train, Y_train, categorical_feature = categorical_feature)
+        valid_set = lgb.Dataset(X_test, Y_test, categorical_feature = categorical_feature, reference = train_set)
+
+        study = optuna.create_study(direction = direction, storage = storage,
+                                    study_name = model.__name__ if storage else None,
+                                    load_if_exists = True)
+        # boosters of a resumed study are saved to disk, the best one may come from an earlier run
+        booster = olgb.train(base_params, train_set, valid_sets = [valid_set],
+                             callbacks = [lgb.early_stopping(300, verbose = False)],
+                             study = study, show_progress_bar = False,
+                             model_dir = f"{model.__name__}_boosters" if storage else None)
+
+        params = {param:value for param, value in booster.params.items() 
+                  if param != 'num_class' and not param in _LGBM_ITERATION_PARAMS}
+        params['n_estimators'] = booster.best_iteration or booster.current_iteration()
+
+        # the tuner optimizes the lgbm metric, rate the result like the other models
+        best_value = Optimizer(X, Y, model, lambda trial: params, params_columns, pbar, split_rows = split_rows, **optimize_params
+                               )(optuna.trial.FixedTrial({}))
+        return {"model":model, "params":params, "best_value":best_value}
 
     ##############################################################################
 
@@ -314,6 +701,5 @@ class Conveyor:
             file.write(text)
 
     def _repr_dict_model(self, model:dict) -> str:
-        params = str(model['params'])[1:-1]
-        params = params.replace(':', " =").replace("'", "")
+        params = ", ".join(f"{param} = {value}" for param, value in model['params'].items())
         return f"{model['model'].__name__}({params})\nbest_value = {model['best_value']}"
\ No newline at end of file
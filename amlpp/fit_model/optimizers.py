@@ -1,9 +1,12 @@
-from sklearn.model_selection import cross_val_score, train_test_split
+from sklearn.model_selection import cross_val_score, train_test_split, check_cv
 from sklearn.metrics import get_scorer, make_scorer
+from sklearn.base import is_classifier
+from sklearn.utils import _safe_indexing
 from typing import List, Callable, Tuple
 
 import pandas as pd
 import numpy as np
+import optuna
 import tqdm
 
 ##############################################################################
@@ -16,7 +19,8 @@ class Optimizer(object):
                        cross_validation:bool = True,
                        k_fold:int = 5,
                        greater_is_better = True,
-                       test_size:float = 0.2):
+                       test_size:float = 0.2,
+                       split_rows:Tuple = None):
         
         self.model_params = model_params
         self.fit_params = fit_params
@@ -31,6 +35,15 @@ class Optimizer(object):
         self.cross_validation = cross_validation
         self.test_size = test_size
         self.k_fold = k_fold
+        # the holdout split is the same for every trial (and for every model if split_rows are given)
+        if cross_validation:
+            self.split = None
+        elif split_rows is not None:
+            train_rows, test_rows = split_rows
+            self.split = (_safe_indexing(self.X, train_rows), _safe_indexing(self.X, test_rows),
+                          _safe_indexing(self.Y, train_rows), _safe_indexing(self.Y, test_rows))
+        else:
+            self.split = train_test_split(self.X, self.Y, test_size = test_size, random_state = 42)
 
         
     
@@ -42,13 +55,22 @@ class Optimizer(object):
             scoring = make_scorer(self.rating_func, greater_is_better = self.greater_is_better)
 
         if self.cross_validation:
-            score = cross_val_score(model, self.X, self.Y, cv = self.k_fold, scoring = scoring, fit_params = self.fit_params)
+            score = []
+            cv = check_cv(self.k_fold, self.Y, classifier = is_classifier(model))
+            for step, fold in enumerate(cv.split(self.X, self.Y)):
+                score += list(cross_val_score(model, self.X, self.Y, cv = [fold], scoring = scoring, fit_params = self.fit_params))
+                fold_scores = [sc for sc in score if sc == sc]
+                if fold_scores:
+                    trial.report(np.mean(fold_scores), step)
+                if trial.should_prune():
+                    raise optuna.TrialPruned()
             score = np.mean([sc for sc in score if sc == sc])
             if score != score:
                 raise ValueError('Too small sample for cross validation')
         else:
-            X_train, X_test, Y_train, Y_test = train_test_split(self.X, self.Y, test_size = self.test_size, random_state = 42)
-            score = scoring(model.fit(X_train, Y_train['value']), X_test, Y_test)
+            X_train, X_test, Y_train, Y_test = self.split
+            # rating functions may write into the targets (default_score), trials running in threads get their own copy
+            score = scoring(model.fit(X_train, Y_train['value']), X_test, Y_test.copy())
 
         if tqdm != None:
             self.tqdm_bar.update(score, model.__class__.__name__)
@@ -8,6 +8,10 @@ class BaseTransform(ABC):
     params: dict
         Transformer parameters
     """
+    # True for transformers that only change targets or do nothing at inference,
+    # they are not applied by Conveyor.predict
+    skip_at_predict = False
+
     def __init__(self, params:dict):
         self.attr = params
         